@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Compare the thread and process decode backends on synthetic operations.
+
+Builds REPLACE_XZ, REPLACE_BZ and SOURCE_BSDIFF operations shaped like those
+in a real payload and decodes them with both backends at increasing worker
+counts, the same way Dumper does with --decoder thread/process.
+
+    python benchmarks/decode_backends.py --ops 256 --workers 1,2,4,8,16
+"""
+import argparse
+import bz2
+import lzma
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bsdiff4
+
+from payload_dumper import decode
+from payload_dumper import update_metadata_pb2 as um
+
+BLOCK_SIZE = 4096
+
+
+def _randbytes(rng, n):
+    # random.Random.randbytes needs Python 3.9
+    return rng.getrandbits(8 * n).to_bytes(n, "little")
+
+
+def make_ops(count, size, seed=0):
+    """Return (type, data, old_chunks, out_length) tuples for synthetic ops."""
+    rng = random.Random(seed)
+    ops = []
+    for i in range(count):
+        # Half random, half zero blocks: compresses about as well as a
+        # typical filesystem image
+        new = b"".join(
+            _randbytes(rng, BLOCK_SIZE) if rng.random() < 0.5 else bytes(BLOCK_SIZE)
+            for _ in range(size // BLOCK_SIZE)
+        )
+        kind = i % 3
+        if kind == 0:
+            ops.append((um.InstallOperation.REPLACE_XZ, lzma.compress(new), [], len(new)))
+        elif kind == 1:
+            ops.append((um.InstallOperation.REPLACE_BZ, bz2.compress(new), [], len(new)))
+        else:
+            old = bytearray(new)
+            for _ in range(16):
+                pos = rng.randrange(len(old) - 64)
+                old[pos : pos + 64] = _randbytes(rng, 64)
+            old = bytes(old)
+            ops.append(
+                (um.InstallOperation.SOURCE_BSDIFF, bsdiff4.diff(old, new), [old], len(new))
+            )
+    return ops
+
+
+def run_threads(ops, workers):
+    def work(op):
+        op_type, data, old_chunks, _ = op
+        return len(decode.decode_op(op_type, data, b"".join(old_chunks)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(work, ops))
+
+
+def run_processes(ops, workers):
+    decoder = decode.ProcessDecoder(workers)
+
+    def work(op):
+        return len(decoder.decode(*op))
+
+    try:
+        # Warm the pool up so process start-up isn't timed
+        list(decoder.pool.map(abs, range(workers)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            start = time.perf_counter()
+            total = sum(executor.map(work, ops))
+            return total, time.perf_counter() - start
+    finally:
+        decoder.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ops", type=int, default=192, help="number of operations")
+    parser.add_argument("--op-size", type=int, default=2 << 20, help="decoded bytes per operation")
+    parser.add_argument(
+        "--workers",
+        default=",".join(str(1 << i) for i in range(8) if 1 << i <= os.cpu_count()),
+        help="comma separated worker counts",
+    )
+    args = parser.parse_args()
+
+    print("Generating %d operations of %d KiB..." % (args.ops, args.op_size >> 10))
+    ops = make_ops(args.ops, args.op_size)
+    total_mb = args.ops * args.op_size / 1024**2
+
+    print("%8s %14s %14s %8s" % ("workers", "thread MB/s", "process MB/s", "speedup"))
+    for workers in (int(w) for w in args.workers.split(",")):
+        start = time.perf_counter()
+        threads_total = run_threads(ops, workers)
+        thread_time = time.perf_counter() - start
+        processes_total, process_time = run_processes(ops, workers)
+        assert threads_total == processes_total
+        print(
+            "%8d %14.1f %14.1f %7.2fx"
+            % (workers, total_mb / thread_time, total_mb / process_time, thread_time / process_time)
+        )
+
+
+if __name__ == "__main__":
+    main()
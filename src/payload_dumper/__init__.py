@@ -4,11 +4,15 @@ import os
 import sys
 from multiprocessing import cpu_count
 from urllib.parse import urlparse
-from zipfile import ZipFile
 import enlighten
 import traceback
 
+from . import disk_cache
 from . import http_file
+from . import range_file
+from . import read_plan
+from . import zipfile
+from . import dumper
 from .dumper import Dumper
 from .legacy_rom import LegacyBootExtractor
 from . import image_extractor
@@ -35,7 +39,12 @@ def try_extract_payload(input_file, args):
             images=args.partitions if args.partitions else "",
             workers=args.workers,
             list_partitions=args.list,
-            extract_metadata=args.metadata
+            extract_metadata=args.metadata,
+            read_gap=args.read_gap,
+            max_read_size=args.max_read_size,
+            fetch_workers=args.fetch_workers,
+            write_workers=args.write_workers,
+            decoder=args.decoder
         )
         d.run()
         return True
@@ -43,13 +52,32 @@ def try_extract_payload(input_file, args):
         print(f"[!] payload.bin提取失败：{str(e)}")
         return False
 
-def try_extract_direct(url, args):
+def has_payload(source):
+    """判断输入是payload.bin或包含payload.bin的OTA包，还是只能直接提取镜像的zip"""
+    if bytes(range_file.read_at(source, 0, 4)) == b"CrAU":
+        return True
+    if "payload.bin" in (range_file.read_ota_property_files(source) or {}):
+        return True
+    try:
+        with zipfile.ZipFile(source) as zip_file:
+            return "payload.bin" in zip_file.namelist()
+    except zipfile.BadZipFile:
+        # 交给Dumper报告具体错误
+        return True
+
+def try_extract_direct(source, args):
     """尝试直接提取镜像文件"""
     try:
         extractor = image_extractor.ImageExtractor(
-            url=url,
+            url=args.input,
+            source=source,
             out_dir=args.output,
-            target_images=args.partitions
+            target_images=args.partitions,
+            workers=args.workers,
+            connections=args.connections,
+            disk_cache=args.disk_cache,
+            http2=args.http2,
+            retry_budget=args.retry_budget
         )
         extractor.extract_images()
         return True
@@ -72,6 +100,16 @@ def main():
     parser.add_argument("--workers", "-w", type=int, help="工作线程数", default=os.cpu_count())
     parser.add_argument("--list", "-l", action="store_true", help="列出所有可用分区")
     parser.add_argument("--metadata", "-m", action="store_true", help="提取元数据")
+    parser.add_argument("--connections", "-c", type=int, help="下载大范围数据时的并发连接数", default=http_file.HttpFile.CONNECTIONS)
+    parser.add_argument("--http2", action="store_true", help="使用HTTP/2复用连接（需要安装 httpx[http2]）")
+    parser.add_argument("--retry-budget", type=int, help="整个运行期间允许的网络重试总次数", default=http_file.HttpFile.RETRY_BUDGET)
+    parser.add_argument("--cache-dir", help="远程文件的磁盘缓存目录（默认不启用）")
+    parser.add_argument("--cache-size", type=int, help="磁盘缓存容量上限（MB）", default=disk_cache.DEFAULT_MAX_SIZE >> 20)
+    parser.add_argument("--read-gap", type=int, help="合并读取时允许跳过的最大间隔（字节）", default=read_plan.DEFAULT_MAX_GAP)
+    parser.add_argument("--max-read-size", type=int, help="单次合并读取的最大大小（字节）", default=read_plan.DEFAULT_MAX_SIZE)
+    parser.add_argument("--fetch-workers", type=int, help="提前下载操作数据的线程数", default=dumper.FETCH_WORKERS)
+    parser.add_argument("--decoder", choices=["thread", "process"], help="解码XZ/BZ/BSDIFF操作的方式：thread（线程）或 process（进程池，不受GIL限制）", default="thread")
+    parser.add_argument("--write-workers", type=int, help="写出镜像数据的线程数（0表示由解码线程直接写出）", default=dumper.WRITE_WORKERS)
     
     args = parser.parse_args()
     
@@ -83,6 +121,10 @@ def main():
     
     # 创建输出目录
     os.makedirs(args.output, exist_ok=True)
+
+    args.disk_cache = None
+    if args.cache_dir:
+        args.disk_cache = disk_cache.DiskCache(args.cache_dir, args.cache_size << 20)
     
     # 判断输入是否为URL
     is_url_input = args.input.startswith(("http://", "https://"))
@@ -90,23 +132,26 @@ def main():
     
     try:
         if is_url_input:
-            # 对于URL，先尝试payload.bin方式，失败则尝试直接提取
-            print("[*] 正在尝试 payload.bin 方式提取...")
-            input_file = http_file.HttpFile(args.input)
-            if try_extract_payload(input_file, args):
-                success = True
-            else:
-                # 清屏并显示新的提取方式
-                clear_screen()
-                print("[*] 正在尝试直接提取镜像文件...")
-                if try_extract_direct(args.input, args):
-                    success = True
+            input_file = http_file.HttpFile(args.input, connections=args.connections,
+                                            disk_cache=args.disk_cache, http2=args.http2,
+                                            retry_budget=args.retry_budget)
         else:
-            # 对于本地文件，只尝试payload.bin方式
-            print("[*] 正在尝试从本地文件提取...")
-            with open(args.input, "rb") as input_file:
+            input_file = open(args.input, "rb")
+
+        # 先判断格式：有payload.bin时按payload方式提取，失败或没有时直接提取镜像。
+        # 两种方式共用同一个输入文件，已下载的数据和目录不会重复获取
+        with input_file:
+            if has_payload(input_file):
+                print("[*] 正在尝试 payload.bin 方式提取...")
                 if try_extract_payload(input_file, args):
                     success = True
+                else:
+                    # 清屏并显示新的提取方式
+                    clear_screen()
+            if not success:
+                print("[*] 正在尝试直接提取镜像文件...")
+                if try_extract_direct(input_file, args):
+                    success = True
                     
         if not success:
             print("\n[!] 提取失败：所有提取方式均未成功")
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
 from . import main
 
-main()
+if __name__ == "__main__":
+    main()
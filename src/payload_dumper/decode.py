@@ -0,0 +1,199 @@
+import bz2
+import lzma
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import bsdiff4
+
+from . import update_metadata_pb2 as um
+
+# Largest chunk of a REPLACE_XZ/REPLACE_BZ operation decompressed at once.
+DECODE_CHUNK = 1 << 20
+
+# Largest decoded size of a REPLACE_XZ/REPLACE_BZ operation handed to the
+# worker processes. Larger ones are decompressed a chunk at a time by the
+# calling thread, so no thread holds a whole huge operation in memory.
+MAX_PROCESS_OUTPUT = 16 << 20
+
+# Shared memory segments up to this size are kept for the next operation.
+# Larger ones only live until the calling thread decodes its next operation.
+_KEEP_SIZE = 16 << 20
+
+# Shared memory segments a worker process keeps attached between operations.
+_MAX_ATTACHED = 16
+
+_attached = {}
+
+
+def _decompressor(op_type):
+    if op_type == um.InstallOperation.REPLACE_XZ:
+        return lzma.LZMADecompressor()
+    if op_type == um.InstallOperation.REPLACE_BZ:
+        return bz2.BZ2Decompressor()
+    return None
+
+
+def iter_decompress(op_type, data, chunk_size=DECODE_CHUNK):
+    """Yield the decompressed data of a REPLACE_XZ or REPLACE_BZ operation in
+    chunks of at most `chunk_size` bytes, so an operation that expands to
+    hundreds of MB never exists in memory as a whole."""
+    dec = _decompressor(op_type)
+    while not dec.eof:
+        chunk = dec.decompress(data, chunk_size)
+        data = b""
+        if not chunk and dec.needs_input:
+            break
+        yield chunk
+
+
+def decompress_into(op_type, data, out):
+    """Decompress a REPLACE_XZ or REPLACE_BZ operation straight into `out`,
+    stopping when it is full, and return the number of bytes written."""
+    dec = _decompressor(op_type)
+    n = 0
+    while n < len(out) and not dec.eof:
+        chunk = dec.decompress(data, min(len(out) - n, DECODE_CHUNK))
+        data = b""
+        if not chunk and dec.needs_input:
+            break
+        out[n : n + len(chunk)] = chunk
+        n += len(chunk)
+    return n
+
+
+def decode_op(op_type, data, old_data=b""):
+    """Decode the data of one REPLACE_XZ, REPLACE_BZ or SOURCE_BSDIFF
+    operation. `old_data` is the concatenated source extents for
+    SOURCE_BSDIFF."""
+    if _decompressor(op_type) is not None:
+        return b"".join(iter_decompress(op_type, data))
+    if op_type == um.InstallOperation.SOURCE_BSDIFF:
+        return bsdiff4.patch(bytes(old_data), bytes(data))
+    raise ValueError("Unsupported type = %d" % op_type)
+
+
+def _attach(name):
+    shm = _attached.get(name)
+    if shm is None:
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+    return shm.buf
+
+
+def _decode_shared(op_type, data_name, data_length, old_name, old_length, out_name, out_length):
+    # Runs in a worker process: decodes from one shared segment into another
+    # and returns the decoded length.
+    if len(_attached) > _MAX_ATTACHED:
+        # Segments the parent has replaced since
+        for shm in _attached.values():
+            shm.close()
+        _attached.clear()
+    try:
+        return _decode_attached(
+            op_type, data_name, data_length, old_name, old_length, out_name, out_length
+        )
+    finally:
+        # The parent replaces segments this large after one operation, so
+        # they aren't kept mapped here either
+        for name, shm in list(_attached.items()):
+            if shm.size > _KEEP_SIZE:
+                try:
+                    shm.close()
+                except BufferError:
+                    # Still referenced by a failed decode's traceback
+                    continue
+                del _attached[name]
+
+
+def _decode_attached(op_type, data_name, data_length, old_name, old_length, out_name, out_length):
+    data = _attach(data_name)[:data_length]
+    if _decompressor(op_type) is not None:
+        return decompress_into(op_type, data, _attach(out_name)[:out_length])
+    old = _attach(old_name)[:old_length] if old_name else b""
+    decoded = decode_op(op_type, data, old)
+    n = min(len(decoded), out_length)
+    _attach(out_name)[:n] = memoryview(decoded)[:n]
+    return n
+
+
+class SharedBuffer:
+    """A shared memory segment owned by this process, recreated when an
+    operation doesn't fit or when it is larger than needed and worth
+    freeing."""
+
+    def __init__(self):
+        self.shm = None
+
+    def get(self, size):
+        # Whole chunks, so slowly growing operations don't recreate it each time
+        size = max(-(-size // DECODE_CHUNK), 1) * DECODE_CHUNK
+        if self.shm is None or self.shm.size < size or self.shm.size > max(size, _KEEP_SIZE):
+            self.close()
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        return self.shm
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class ProcessDecoder:
+    """Decodes operations on a pool of worker processes, so decoding isn't
+    limited by the GIL. Operation data, source extents and decoded output are
+    passed through shared memory segments, one set per calling thread, instead
+    of being pickled."""
+
+    def __init__(self, workers):
+        # Workers are spawned rather than forked: forking while the fetch and
+        # write threads hold locks can deadlock the child. Spawned workers
+        # also share our resource tracker, so the segments they attach
+        # aren't unlinked when they exit.
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.buffers = []
+
+    def _buffers(self):
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None:
+            buffers = self.local.buffers = (SharedBuffer(), SharedBuffer(), SharedBuffer())
+            with self.lock:
+                self.buffers.extend(buffers)
+        return buffers
+
+    def decode(self, op_type, data, old_chunks, out_length):
+        """Decode an operation and return a view of at most `out_length`
+        decoded bytes. The view stays valid until the calling thread decodes
+        the next operation."""
+        data_buffer, old_buffer, out_buffer = self._buffers()
+        data_shm = data_buffer.get(len(data))
+        data_shm.buf[: len(data)] = data
+
+        old_name = None
+        old_length = sum(len(chunk) for chunk in old_chunks)
+        if old_chunks:
+            old_shm = old_buffer.get(old_length)
+            pos = 0
+            for chunk in old_chunks:
+                old_shm.buf[pos : pos + len(chunk)] = chunk
+                pos += len(chunk)
+            old_name = old_shm.name
+
+        out_shm = out_buffer.get(out_length)
+        n = self.pool.submit(
+            _decode_shared, op_type, data_shm.name, len(data),
+            old_name, old_length, out_shm.name, out_length,
+        ).result()
+        return out_shm.buf[:n]
+
+    def close(self):
+        self.pool.shutdown()
+        with self.lock:
+            for buffer in self.buffers:
+                buffer.close()
+            self.buffers = []
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 10 << 30  # 缓存目录的默认容量上限
+EVICT_INTERVAL = 64 << 20  # 每写入这么多字节检查一次容量，并保存一次索引
+
+
+def _merge(ranges, start, end):
+    """将 [start, end) 并入有序且互不重叠的区间列表"""
+    merged = []
+    for a, b in ranges:
+        if b < start or a > end:
+            merged.append([a, b])
+        else:
+            start = min(start, a)
+            end = max(end, b)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+
+class CacheEntry:
+    """单个远程文件的稀疏缓存：数据文件 + 记录已缓存区间的索引文件"""
+
+    def __init__(self, cache, key, url, validator, size):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.validator = validator
+        self.size = size
+        self.data_path = os.path.join(cache.directory, key + ".data")
+        self.index_path = os.path.join(cache.directory, key + ".json")
+        self.lock = threading.Lock()
+        self.ranges = []
+        self.unsaved = 0  # 上次保存索引后写入的字节数
+
+        index = self._load_index()
+        if index is not None and os.path.exists(self.data_path):
+            self.ranges = index["ranges"]
+        else:
+            # 索引与数据文件对不上时丢弃旧索引
+            try:
+                os.remove(self.index_path)
+            except OSError:
+                pass
+        with open(self.data_path, "ab") as f:
+            if f.tell() != size:
+                f.truncate(size)
+        self.file = open(self.data_path, "r+b")
+        self._save_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if index.get("validator") != self.validator or index.get("size") != self.size:
+            return None
+        return index
+
+    def _save_index(self):
+        # 其他进程可能同时在写同一个条目，合并它们记录的区间
+        index = self._load_index()
+        if index is not None:
+            for a, b in index["ranges"]:
+                self.ranges = _merge(self.ranges, a, b)
+        tmp = "%s.%d.tmp" % (self.index_path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({
+                "url": self.url,
+                "validator": self.validator,
+                "size": self.size,
+                "ranges": self.ranges,
+                "last_used": time.time(),
+            }, f)
+        os.replace(tmp, self.index_path)
+
+    def missing(self, start, end):
+        """返回 [start, end) 中尚未缓存的区间"""
+        gaps = []
+        with self.lock:
+            for a, b in self.ranges:
+                if b <= start:
+                    continue
+                if a >= end:
+                    break
+                if a > start:
+                    gaps.append((start, a))
+                start = max(start, b)
+        if start < end:
+            gaps.append((start, end))
+        return gaps
+
+    def read(self, start, size):
+        with self.lock:
+            self.file.seek(start)
+            return self.file.read(size)
+
+    def readinto(self, start, view):
+        with self.lock:
+            self.file.seek(start)
+            self.file.readinto(view)
+
+    def write(self, start, data):
+        with self.lock:
+            self.file.seek(start)
+            self.file.write(data)
+            self.file.flush()
+            self.ranges = _merge(self.ranges, start, start + len(data))
+            # 索引定期保存，中断时最多重新下载最后这部分数据
+            self.unsaved += len(data)
+            if self.unsaved >= EVICT_INTERVAL:
+                self.unsaved = 0
+                self._save_index()
+        self.cache.account(len(data))
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+                self._save_index()
+        self.cache.release(self.key)
+
+    def invalidate(self):
+        with self.lock:
+            self.ranges = []
+        self.close()
+        for path in (self.index_path, self.data_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class DiskCache:
+    """持久化的远程文件范围缓存，按 URL + ETag/Last-Modified + 大小区分条目，
+    超出容量时按最近使用时间淘汰"""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.written = 0
+        self.open_keys = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, url, validator, size):
+        key = hashlib.sha256(f"{url}\n{validator}\n{size}".encode()).hexdigest()
+        with self.lock:
+            self.open_keys.add(key)
+        entry = CacheEntry(self, key, url, validator, size)
+        self.evict()
+        return entry
+
+    def release(self, key):
+        with self.lock:
+            self.open_keys.discard(key)
+
+    def account(self, n):
+        with self.lock:
+            self.written += n
+            if self.written < EVICT_INTERVAL:
+                return
+            self.written = 0
+        self.evict()
+
+    def evict(self):
+        """删除最久未使用的条目，直到缓存总大小不超过上限"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            index_path = os.path.join(self.directory, name)
+            data_path = os.path.join(self.directory, key + ".data")
+            try:
+                with open(index_path) as f:
+                    last_used = json.load(f).get("last_used", 0)
+                st = os.stat(data_path)
+            except (OSError, ValueError):
+                continue
+            # 数据文件是稀疏的，按实际占用的磁盘空间计算
+            used = st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+            total += used
+            entries.append((last_used, key, used, index_path, data_path))
+
+        entries.sort()
+        for last_used, key, used, index_path, data_path in entries:
+            if total <= self.max_size:
+                break
+            with self.lock:
+                if key in self.open_keys:
+                    continue
+            for path in (index_path, data_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= used
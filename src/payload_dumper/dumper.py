@@ -1,20 +1,20 @@
 #!/usr/bin/env python
-import bz2
 import hashlib
-import io
 import json
-import lzma
 import os
 import struct
 import sys
+import threading
 from . import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from multiprocessing import cpu_count
 
-import bsdiff4
 from enlighten import get_manager
 
+from . import decode
 from . import http_file
+from . import range_file
+from . import read_plan
 from . import update_metadata_pb2 as um
 
 flatten = lambda l: [item for sublist in l for item in sublist]
@@ -39,48 +39,139 @@ def verify_contiguous(exts):
     return True
 
 
+def verify_disjoint(ops):
+    end = 0
+    for start, num in sorted(
+        (ext.start_block, ext.num_blocks) for op in ops for ext in op.dst_extents
+    ):
+        if start < end:
+            return False
+
+        end = start + num
+
+    return True
+
+
+class PartitionFiles:
+    """Output (and, for diff OTAs, source) image of one partition, shared by
+    all workers processing its operations."""
+
+    def __init__(self, name, out, old=None, size=0):
+        self.name = name
+        # The source image is opened first, so a missing one doesn't leave an
+        # empty output image behind
+        if old:
+            self.old_file = open("%s/%s.img" % (old, name), "rb")
+        else:
+            self.old_file = None
+        # Unbuffered, and written with positional writes: operations write
+        # their extents concurrently without sharing a file position
+        self.out_file = open("%s/%s.img" % (out, name), "wb", buffering=0)
+        # Created at its final size up front, so blocks no operation writes
+        # (ZERO and DISCARD extents) stay holes in a sparse file
+        self.out_file.truncate(size)
+        self.remaining = 0
+        self.failed = False
+        # Set when operations may overwrite each other's extents, so their
+        # writes have to land in order
+        self.ordered = False
+        self.writes = set()
+        self.writes_lock = threading.Lock()
+
+    def write(self, offset, data):
+        range_file.write_at(self.out_file, offset, data)
+
+    def track(self, future):
+        with self.writes_lock:
+            self.writes.add(future)
+        future.add_done_callback(self._untrack)
+
+    def _untrack(self, future):
+        if future.exception() is None:
+            with self.writes_lock:
+                self.writes.discard(future)
+
+    def wait_writes(self):
+        """Wait for queued writes and raise the first one that failed."""
+        with self.writes_lock:
+            writes = list(self.writes)
+        wait(writes)
+        for future in writes:
+            future.result()
+
+    def read_old(self, offset, size):
+        return range_file.read_at(self.old_file, offset, size)
+
+    def close(self):
+        self.out_file.close()
+        if self.old_file is not None:
+            self.old_file.close()
+
+
+# Zeros written over ZERO/DISCARD extents that may already hold data
+ZEROS = memoryview(bytes(1 << 20))
+
+# Threads fetching operation data ahead of the decoding workers, and threads
+# writing decoded data to the output images
+FETCH_WORKERS = 2
+WRITE_WORKERS = 2
+# Decoded buffers each writer thread may have queued before decoding blocks
+WRITE_QUEUE_DEPTH = 4
+
+
 class Dumper:
     def __init__(
-        self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), list_partitions=False, extract_metadata=False
+        self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), list_partitions=False, extract_metadata=False,
+        read_gap=read_plan.DEFAULT_MAX_GAP, max_read_size=read_plan.DEFAULT_MAX_SIZE,
+        fetch_workers=FETCH_WORKERS, write_workers=WRITE_WORKERS, decoder="thread"
     ):
         self.payloadfile = payloadfile
         self.manager = get_manager()
         self.download_progress = None
-        if isinstance(payloadfile, http_file.HttpFile):
+        self.progress_lock = threading.Lock()
+        self.remote = isinstance(payloadfile, http_file.HttpFile)
+        if self.remote:
             payloadfile.progress_reporter = self.update_download_progress
         self.out = out
         self.diff = diff
         self.old = old
         self.images = images
         self.workers = workers
+        self.read_gap = read_gap
+        self.max_read_size = max_read_size
+        self.read_plan = None
+        self.fetch_workers = fetch_workers
+        self.write_workers = write_workers
+        self.writer = None
+        self.write_slots = None
+        self.decoder_type = decoder
+        self.decoder = None
         self.list_partitions = list_partitions
         self.extract_metadata = extract_metadata
 
         if self.extract_metadata:
             self.extract_and_display_metadata()
         else:
+            # OTA packages record where payload.bin is in their metadata,
+            # which avoids reading the central directory
+            self.payloadfile = range_file.open_ota_payload(payloadfile) or payloadfile
             try:
                 self.parse_metadata()
             except AssertionError:
                 # try zip
-                with zipfile.ZipFile(self.payloadfile, "r") as zip_file:
-                    self.payloadfile = zip_file.open("payload.bin", "r")
+                with zipfile.ZipFile(payloadfile, "r") as zip_file:
+                    self.payloadfile = range_file.open_member(zip_file, "payload.bin")
                 self.parse_metadata()
                 pass
 
             if self.list_partitions:
                 self.list_partitions_info()
 
-    def update_download_progress(self, prog, total):
-        if self.download_progress is None and prog != total:
-            self.download_progress = self.manager.counter(
-                total=total, desc="download", unit="b", leave=False
-            )
-        if self.download_progress is not None:
-            self.download_progress.update(prog - self.download_progress.count)
-            if prog == total:
-                self.download_progress.close()
-                self.download_progress = None
+    def update_download_progress(self, count):
+        # Called by concurrent fetches with the bytes each one received
+        with self.progress_lock:
+            if self.download_progress is not None:
+                self.download_progress.update(count)
 
     def run(self):
         if self.list_partitions or self.extract_metadata:
@@ -105,59 +196,188 @@ class Dumper:
             print("Not operating on any partitions")
             return 0
 
-        partitions_with_ops = []
-        for partition in partitions:
-            operations = []
-            for operation in partition.operations:
-                self.payloadfile.seek(self.data_offset + operation.data_offset)
-                operations.append(
-                    {
-                        "operation": operation,
-                        "data": self.payloadfile.read(operation.data_length),
-                    }
-                )
-            partitions_with_ops.append(
-                {
-                    "partition": partition,
-                    "operations": operations,
-                }
+        self.read_plan = read_plan.plan_reads(
+            [
+                (op.data_offset, op.data_length)
+                for part in partitions
+                for op in part.operations
+            ],
+            self.read_gap,
+            self.max_read_size,
+            # Batching only pays off if the source can fetch several ranges
+            # in one request.
+            read_plan.DEFAULT_MAX_RANGES
+            if hasattr(self.payloadfile, "read_ranges")
+            else 1,
+        )
+        data_length = sum(
+            op.data_length for part in partitions for op in part.operations
+        )
+        print(
+            "Read plan: %d requests, %.1fMB (%.1fMB of operation data)"
+            % (
+                self.read_plan.request_count,
+                self.read_plan.total_bytes / 1024**2,
+                data_length / 1024**2,
             )
+        )
 
+        if self.remote:
+            # Fetches report the bytes they received, summed up against
+            # everything the plan reads
+            self.download_progress = self.manager.counter(
+                total=self.read_plan.total_bytes, desc="download", unit="b", leave=False
+            )
+        self.multiprocess_partitions(partitions)
+        with self.progress_lock:
+            if self.download_progress is not None:
+                self.download_progress.close()
+                self.download_progress = None
         self.payloadfile.close()
-
-        self.multiprocess_partitions(partitions_with_ops)
         self.manager.stop()
 
     def multiprocess_partitions(self, partitions):
         progress_bars = {}
+        # Counters are updated by every decoding thread, and an enlighten
+        # update isn't atomic and redraws the terminal, so they share the
+        # download counter's lock
 
         def update_progress(partition_name, count):
-            progress_bars[partition_name].update(count)
-
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            for part in partitions:
-                partition_name = part["partition"].partition_name
-                progress_bars[partition_name] = self.manager.counter(
-                    total=len(part["operations"]),
-                    desc=f"{partition_name}",
-                    unit="ops",
-                    leave=True,
-                )
-
-            futures = {
-                executor.submit(self.dump_part, part, update_progress): part
-                for part in partitions
-            }
-
-            for future in as_completed(futures):
-                part = futures[future]
-                partition_name = part["partition"].partition_name
+            with self.progress_lock:
+                progress_bars[partition_name].update(count)
+
+        def close_progress(partition_name):
+            with self.progress_lock:
+                progress_bars[partition_name].close()
+
+        # Fetch, decode and write run as separate stages: fetch threads load
+        # coalesced reads ahead of the decoding workers, which hand decoded
+        # data to the writer threads. Each hand-off is bounded, so a slow
+        # stage holds back the ones before it instead of buffering data.
+        stopped = threading.Event()
+        fetch_slots = threading.Semaphore(read_plan.DEFAULT_PREFETCH_BATCHES)
+        fetchers = [
+            threading.Thread(
+                target=self.read_plan.prefetch,
+                args=(self.read_payload, fetch_slots, stopped),
+                daemon=True,
+            )
+            for _ in range(self.fetch_workers)
+        ]
+        for fetcher in fetchers:
+            fetcher.start()
+        try:
+            self.write_slots = threading.Semaphore(self.write_workers * WRITE_QUEUE_DEPTH)
+            if self.decoder_type == "process":
+                self.decoder = decode.ProcessDecoder(self.workers)
+
+            with ThreadPoolExecutor(max_workers=max(1, self.write_workers)) as writer, \
+                    ThreadPoolExecutor(max_workers=self.workers) as executor:
+                self.writer = writer if self.write_workers > 0 else None
+                futures = {}
                 try:
-                    future.result()
-                    progress_bars[partition_name].close()
-                except Exception as exc:
-                    print(f"{partition_name} - processing generated an exception: {exc}")
-                    progress_bars[partition_name].close()
+                    for part in partitions:
+                        partition_name = part.partition_name
+                        with self.progress_lock:
+                            progress_bars[partition_name] = self.manager.counter(
+                                total=len(part.operations),
+                                desc=f"{partition_name}",
+                                unit="ops",
+                                leave=True,
+                            )
+                        try:
+                            files = PartitionFiles(
+                                partition_name, self.out, self.old if self.diff else None,
+                                self.partition_size(part),
+                            )
+                        except Exception as exc:
+                            # e.g. a missing source image: only this partition fails
+                            print(f"{partition_name} - processing generated an exception: {exc}")
+                            close_progress(partition_name)
+                            self.skip_ops(part.operations)
+                            continue
+
+                        # Operations writing disjoint extents can run in any order, so
+                        # they are queued individually and spread over all workers.
+                        # Otherwise the partition is processed serially by one worker.
+                        if verify_disjoint(part.operations):
+                            for op in part.operations:
+                                future = executor.submit(
+                                    self.dump_op, op, files, update_progress
+                                )
+                                futures[future] = files
+                            files.remaining = len(part.operations)
+                        else:
+                            files.ordered = True
+                            future = executor.submit(
+                                self.dump_part, part, files, update_progress
+                            )
+                            futures[future] = files
+                            files.remaining = 1
+
+                        if files.remaining == 0:
+                            files.close()
+                            close_progress(partition_name)
+
+                    for future in as_completed(futures):
+                        files = futures[future]
+                        try:
+                            future.result()
+                        except Exception as exc:
+                            if not files.failed:
+                                files.failed = True
+                                print(f"{files.name} - processing generated an exception: {exc}")
+                        files.remaining -= 1
+                        if files.remaining == 0:
+                            try:
+                                files.wait_writes()
+                            except Exception as exc:
+                                if not files.failed:
+                                    files.failed = True
+                                    print(f"{files.name} - processing generated an exception: {exc}")
+                            files.close()
+                            close_progress(files.name)
+                except BaseException:
+                    # Don't leave queued operations running once the run is
+                    # aborted
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            # Also reached when the run is aborted, so the fetchers and the
+            # decoder's processes and shared memory don't outlive it
+            stopped.set()
+            for fetcher in fetchers:
+                fetcher.join()
+            self.writer = None
+            if self.decoder is not None:
+                self.decoder.close()
+                self.decoder = None
+
+    def partition_size(self, part):
+        """Size of a partition's output image: new_partition_info.size, or
+        the end of its last extent for payloads that don't record it."""
+        end = max(
+            (ext.start_block + ext.num_blocks for op in part.operations for ext in op.dst_extents),
+            default=0,
+        )
+        return max(part.new_partition_info.size, end * self.block_size)
+
+    def write(self, files, offset, data, sync=False):
+        """Queue a write of decoded data on the writer threads, blocking while
+        too many writes are queued already. With `sync`, or when writes have
+        to stay in order, the data is written before returning."""
+        if sync or self.writer is None or files.ordered:
+            files.write(offset, data)
+            return
+        self.write_slots.acquire()
+        try:
+            future = self.writer.submit(files.write, offset, data)
+        except BaseException:
+            self.write_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.write_slots.release())
+        files.track(future)
 
     def parse_metadata(self):
         head_len = 4 + 8 + 8 + 4
@@ -183,79 +403,135 @@ class Dumper:
         self.dam.ParseFromString(manifest)
         self.block_size = self.dam.block_size
 
-    def data_for_op(self, operation, out_file, old_file):
-        data = operation["data"]
-        op = operation["operation"]
-
+    def read_payload(self, ranges):
+        # Positional reads, so workers fetch op data concurrently
+        ranges = [(self.data_offset + offset, length) for offset, length in ranges]
+        if hasattr(self.payloadfile, "read_ranges"):
+            return self.payloadfile.read_ranges(ranges)
+        return [
+            range_file.read_at(self.payloadfile, offset, length)
+            for offset, length in ranges
+        ]
+
+    def read_op_data(self, op):
+        # Op data is fetched on demand, one coalesced read at a time, so only
+        # the ranges currently being processed by the workers are in memory.
+        if op.data_length == 0:
+            return b""
+        return self.read_plan.read(op.data_offset, op.data_length, self.read_payload)
+
+    def decode(self, op, data, files):
+        """Decode the data of a REPLACE_XZ, REPLACE_BZ or SOURCE_BSDIFF
+        operation, on the process pool if one is in use."""
+        old_chunks = []
+        if op.type == op.SOURCE_BSDIFF:
+            old_chunks = [
+                files.read_old(
+                    ext.start_block * self.block_size, ext.num_blocks * self.block_size
+                )
+                for ext in op.src_extents
+            ]
+        if self.decoder is None:
+            return memoryview(decode.decode_op(op.type, data, b"".join(old_chunks)))
+        length = sum(ext.num_blocks for ext in op.dst_extents) * self.block_size
+        return self.decoder.decode(op.type, data, old_chunks, length)
+
+    def write_extents(self, files, extents, chunks, sync=False):
+        """Write a stream of decoded chunks across `extents` in order,
+        dropping anything past their end."""
+        extents = iter(extents)
+        pos = remaining = 0
+        for chunk in chunks:
+            chunk = memoryview(chunk)
+            while chunk:
+                if not remaining:
+                    ext = next(extents, None)
+                    if ext is None:
+                        return
+                    pos = ext.start_block * self.block_size
+                    remaining = ext.num_blocks * self.block_size
+                n = min(len(chunk), remaining)
+                self.write(files, pos, chunk[:n], sync)
+                chunk = chunk[n:]
+                pos += n
+                remaining -= n
+
+    def data_for_op(self, op, data, files):
         # assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
 
-        if op.type == op.REPLACE_XZ:
-            dec = lzma.LZMADecompressor()
-            data = dec.decompress(data)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            out_file.write(data)
-        elif op.type == op.REPLACE_BZ:
-            dec = bz2.BZ2Decompressor()
-            data = dec.decompress(data)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            out_file.write(data)
+        # Data decoded by the process pool is in a buffer that this thread
+        # reuses for its next operation, so it is written out right away
+        sync = self.decoder is not None
+
+        if op.type == op.REPLACE_XZ or op.type == op.REPLACE_BZ:
+            length = sum(ext.num_blocks for ext in op.dst_extents) * self.block_size
+            if self.decoder is None or length > decode.MAX_PROCESS_OUTPUT:
+                # Decompressed a chunk at a time, so memory use doesn't grow
+                # with the size of the operation
+                chunks = decode.iter_decompress(op.type, data)
+                sync = False
+            else:
+                chunks = [self.decode(op, data, files)]
+            self.write_extents(files, op.dst_extents, chunks, sync)
         elif op.type == op.REPLACE:
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            out_file.write(data)
+            self.write_extents(files, op.dst_extents, [data])
         elif op.type == op.SOURCE_COPY:
             if not self.diff:
                 print("SOURCE_COPY supported only for differential OTA")
                 sys.exit(-2)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            for ext in op.src_extents:
-                old_file.seek(ext.start_block * self.block_size)
-                data = old_file.read(ext.num_blocks * self.block_size)
-                out_file.write(data)
+            chunks = (
+                files.read_old(
+                    ext.start_block * self.block_size, ext.num_blocks * self.block_size
+                )
+                for ext in op.src_extents
+            )
+            self.write_extents(files, op.dst_extents, chunks)
         elif op.type == op.SOURCE_BSDIFF:
             if not self.diff:
                 print("SOURCE_BSDIFF supported only for differential OTA")
                 sys.exit(-3)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            tmp_buff = io.BytesIO()
-            for ext in op.src_extents:
-                old_file.seek(ext.start_block * self.block_size)
-                old_data = old_file.read(ext.num_blocks * self.block_size)
-                tmp_buff.write(old_data)
-            tmp_buff.seek(0)
-            old_data = tmp_buff.read()
-            tmp_buff.seek(0)
-            tmp_buff.write(bsdiff4.patch(old_data, data))
-            n = 0
-            tmp_buff.seek(0)
-            for ext in op.dst_extents:
-                tmp_buff.seek(n * self.block_size)
-                n += ext.num_blocks
-                data = tmp_buff.read(ext.num_blocks * self.block_size)
-                out_file.seek(ext.start_block * self.block_size)
-                out_file.write(data)
-        elif op.type == op.ZERO:
-            for ext in op.dst_extents:
-                out_file.seek(ext.start_block * self.block_size)
-                out_file.write(b"\x00" * ext.num_blocks * self.block_size)
+            data = self.decode(op, data, files)
+            self.write_extents(files, op.dst_extents, [data], sync)
+        elif op.type == op.ZERO or op.type == op.DISCARD:
+            # The output starts out as a sparse file, so these extents read
+            # as zeros unless an earlier operation wrote over them, which can
+            # only happen when operations aren't disjoint
+            if files.ordered:
+                length = sum(ext.num_blocks for ext in op.dst_extents) * self.block_size
+                zeros = (ZEROS for _ in range(0, length, len(ZEROS)))
+                self.write_extents(files, op.dst_extents, zeros)
         else:
             print("Unsupported type = %d" % op.type)
             sys.exit(-1)
 
         return data
 
-    def dump_part(self, part, update_callback):
-        name = part["partition"].partition_name
-        out_file = open("%s/%s.img" % (self.out, name), "wb")
-        h = hashlib.sha256()
-
-        if self.diff:
-            old_file = open("%s/%s.img" % (self.old, name), "rb")
-        else:
-            old_file = None
+    def dump_op(self, op, files, update_callback):
+        if files.failed:
+            self.skip_ops([op])
+            return
+        data = self.read_op_data(op)
+        self.data_for_op(op, data, files)
+        update_callback(files.name, 1)
 
-        for op in part["operations"]:
-            data = self.data_for_op(op, out_file, old_file)
-            update_callback(part["partition"].partition_name, 1)
+    def dump_part(self, part, files, update_callback):
+        ops = iter(part.operations)
+        try:
+            for op in ops:
+                data = self.read_op_data(op)
+                self.data_for_op(op, data, files)
+                update_callback(files.name, 1)
+        except BaseException:
+            self.skip_ops(ops)
+            raise
+
+    def skip_ops(self, ops):
+        # Release the data of operations that won't be processed, or the
+        # reads holding it would never be freed and would keep prefetch
+        # slots taken
+        for op in ops:
+            if op.data_length:
+                self.read_plan.discard(op.data_offset)
 
     def list_partitions_info(self):
         partitions_info = []
@@ -1,14 +1,51 @@
 import io
 import os
+import random
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import httpx
 
+try:
+    import h2  # noqa: F401  httpx的HTTP/2支持依赖h2
+except ImportError:
+    h2 = None
+
+
+class RemoteFileChanged(IOError):
+    pass
+
+
+class RetryableError(IOError):
+    """服务器暂时不可用或响应不完整，重试可能成功"""
+    pass
+
+
+# 只有这些错误会消耗重试预算；404、416等其他状态码重试也不会成功，立即失败
+RETRYABLE_ERRORS = (httpx.TransportError, RetryableError)
+
+
+def _check_retryable(status_code: int) -> None:
+    if status_code >= 500 or status_code == 429:
+        raise RetryableError(f"服务器暂时不可用，状态码: {status_code}")
+
 
 class HttpFile(io.RawIOBase):
-    MAX_RETRIES = 3
-    RETRY_DELAY = 1
+    RETRY_BUDGET = 20  # 整个运行期间允许的重试总次数
+    RETRY_DELAY = 1  # 指数退避的初始等待时间
+    RETRY_MAX_DELAY = 30
     TIMEOUT = 30.0  # 30秒超时
-    
+    CONNECTIONS = 4  # 大范围读取时的并发连接数
+    MIN_CHUNK_SIZE = 1 << 20
+    MAX_CHUNK_SIZE = 32 << 20
+    CHUNK_SECONDS = 2.0  # 自适应分块的目标耗时
+    BLOCK_SIZE = 64 << 10  # 缓存块大小
+    CACHE_SIZE = 32 << 20  # 缓存总大小
+    READ_AHEAD = 512 << 10  # 小范围读取未命中时的预读窗口
+    INITIAL_FETCH = 1 << 20  # 第一个请求预取的字节数
+
     def seekable(self) -> bool:
         return True
 
@@ -18,66 +55,353 @@ class HttpFile(io.RawIOBase):
     def writable(self) -> bool:
         return False
 
-    def _read_with_retry(self, start_pos: int, size: int) -> bytes:
+    def _read_with_retry(self, start_pos: int, size: int) -> bytearray:
         """带重试的读取函数"""
-        headers = {"Range": f"bytes={start_pos}-{start_pos + size - 1}"}
-        retries = 0
-        last_error = None
-        
-        while retries < self.MAX_RETRIES:
+        buf = bytearray(size)
+        self._read_into(start_pos, memoryview(buf))
+        return buf
+
+    def _read_into(self, start_pos: int, view: memoryview) -> None:
+        """读取到调用方的缓冲区，启用磁盘缓存时只下载缺失的部分"""
+        if self.cache_entry is None:
+            self._fetch_into(start_pos, view)
+            return
+
+        pos = start_pos
+        for gap_start, gap_end in self.cache_entry.missing(start_pos, start_pos + len(view)):
+            if gap_start > pos:
+                self.cache_entry.readinto(pos, view[pos - start_pos:gap_start - start_pos])
+            gap = view[gap_start - start_pos:gap_end - start_pos]
+            self._fetch_into(gap_start, gap)
+            self.cache_entry.write(gap_start, gap)
+            pos = gap_end
+        if pos < start_pos + len(view):
+            self.cache_entry.readinto(pos, view[pos - start_pos:])
+
+    def _fetch(self, start_pos: int, size: int) -> bytearray:
+        buf = bytearray(size)
+        self._fetch_into(start_pos, memoryview(buf))
+        return buf
+
+    def _fetch_into(self, start_pos: int, view: memoryview) -> None:
+        """从服务器下载指定范围并直接写入缓冲区，失败后从已收到的最后一个字节处继续。
+        每次请求结束后把收到的字节数报告给progress_reporter"""
+        size = len(view)
+        total_size = 0
+        attempt = 0
+
+        while True:
+            headers = {"Range": f"bytes={start_pos + total_size}-{start_pos + size - 1}"}
+            if self.validator:
+                # 远程文件变化时服务器返回200而不是206，避免混入旧数据
+                headers["If-Range"] = self.validator
+            received = total_size
+            error = None
             try:
                 with self.client.stream("GET", self.url, headers=headers, timeout=self.TIMEOUT) as r:
+                    if r.status_code == 200 and self.validator:
+                        raise RemoteFileChanged("远程文件已发生变化")
+                    _check_retryable(r.status_code)
+                    if r.status_code == 200:
+                        raise io.UnsupportedOperation("服务器不支持范围请求")
                     if r.status_code != 206:
-                        raise io.UnsupportedOperation(f"服务器不支持范围请求，状态码: {r.status_code}")
+                        raise IOError(f"请求失败，状态码: {r.status_code}")
                     
-                    # 读取所有数据到内存
-                    chunks = []
-                    total_size = 0
-                    for chunk in r.iter_bytes(8192):
-                        chunks.append(chunk)
-                        total_size += len(chunk)
-                        if self.progress_reporter:
-                            self.progress_reporter(total_size, size)
+                    for chunk in r.iter_bytes():
+                        n = len(chunk)
+                        if total_size + n > size:
+                            raise ValueError(f"读取的数据大小不匹配: 期望 {size} 字节，服务器返回了更多数据")
+                        view[total_size:total_size + n] = chunk
+                        total_size += n
                     
                     # 验证数据大小
                     if total_size != size:
-                        raise ValueError(f"读取的数据大小不匹配: 期望 {size} 字节，实际读取 {total_size} 字节")
-                    
-                    return b''.join(chunks)
+                        raise RetryableError(f"读取的数据大小不匹配: 期望 {size} 字节，实际读取 {total_size} 字节")
                     
+            except RemoteFileChanged:
+                if self.cache_entry is not None:
+                    self.cache_entry.invalidate()
+                    self.cache_entry = None
+                raise
+            except RETRYABLE_ERRORS as e:
+                error = e
+
+            # 在重试范围之外报告进度，回调出错不会被当作网络错误重试
+            if self.progress_reporter and total_size > received:
+                self.progress_reporter(total_size - received)
+            if error is None:
+                return
+            # 本次请求有进展时说明连接可用，重新开始退避
+            attempt = 0 if total_size > received else attempt + 1
+            self._retry_wait(attempt, error, "读取")
+
+    def _retry_wait(self, attempt: int, error: Exception, action: str) -> None:
+        """消耗一次重试预算，并按带随机抖动的指数退避等待"""
+        with self.retry_lock:
+            if self.retry_budget <= 0:
+                raise IOError(f"{action}失败，重试次数已用完: {str(error)}")
+            self.retry_budget -= 1
+            left = self.retry_budget
+        delay = min(self.RETRY_MAX_DELAY, self.RETRY_DELAY * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        print(f"{action}失败，{delay:.1f}秒后重试（剩余重试次数 {left}）: {str(error)}")
+        time.sleep(delay)
+
+    def read_ranges(self, ranges) -> list:
+        """读取多个 (offset, size) 范围。已在块缓存中的范围（例如第一个请求预取的
+        数据）直接返回，大范围经过readinto_at由多个连接并发下载，其余的尽量合并为一个
+        multipart/byteranges 请求"""
+        ranges = [(offset, min(size, self.size - offset)) for offset, size in ranges]
+        result = [None] * len(ranges)
+        small = []
+        for i, (offset, size) in enumerate(ranges):
+            cached = self._cache_hit(offset, size) if self.cache_size and size > 0 else None
+            if cached is not None:
+                result[i] = cached
+            elif self.connections > 1 and size >= 2 * self.MIN_CHUNK_SIZE:
+                result[i] = self.read_at(offset, size)
+            else:
+                small.append(i)
+        for i, data in zip(small, self._read_batched([ranges[i] for i in small])):
+            result[i] = data
+        return result
+
+    def _read_batched(self, ranges) -> list:
+        if self.cache_entry is None:
+            return self._fetch_ranges(ranges)
+
+        gaps = [
+            (gap_start, gap_end - gap_start)
+            for offset, size in ranges
+            for gap_start, gap_end in self.cache_entry.missing(offset, offset + size)
+        ]
+        for (gap_start, _), data in zip(gaps, self._fetch_ranges(gaps)):
+            self.cache_entry.write(gap_start, data)
+        return [self.cache_entry.read(offset, size) for offset, size in ranges]
+
+    def _fetch_ranges(self, ranges) -> list:
+        parts = []
+        if len(ranges) > 1 and self.multirange:
+            try:
+                parts = self._fetch_multipart(ranges)
+            except RemoteFileChanged:
+                raise
             except Exception as e:
-                last_error = e
-                retries += 1
-                if retries < self.MAX_RETRIES:
-                    print(f"读取失败，{self.RETRY_DELAY}秒后重试 ({retries}/{self.MAX_RETRIES}): {str(e)}")
-                    time.sleep(self.RETRY_DELAY)
-                    # 重新创建客户端以防连接问题
-                    self._recreate_client()
-        
-        raise IOError(f"多次重试后仍然失败: {str(last_error)}")
+                print(f"多范围请求失败，改为逐个请求: {str(e)}")
+            if parts and self.progress_reporter:
+                self.progress_reporter(sum(len(data) for _, data in parts))
 
-    def _recreate_client(self):
-        """重新创建HTTP客户端"""
-        try:
-            self.client.close()
-        except:
-            pass
-        self.client = httpx.Client(timeout=self.TIMEOUT)
+        # 服务器返回200、只返回单个范围或请求失败时，缺失的范围逐个请求
+        result = []
+        for offset, size in ranges:
+            for start, data in parts:
+                if start <= offset and offset + size <= start + len(data):
+                    result.append(memoryview(data)[offset - start:offset - start + size])
+                    break
+            else:
+                result.append(self._fetch(offset, size))
+        return result
 
-    def _read_internal(self, buf: bytes) -> int:
+    def _fetch_multipart(self, ranges) -> list:
+        """发送一个多范围请求，返回服务器实际返回的 (start, data) 列表"""
+        spec = ",".join(f"{offset}-{offset + size - 1}" for offset, size in ranges)
+        headers = {"Range": f"bytes={spec}"}
+        if self.validator:
+            headers["If-Range"] = self.validator
+
+        with self.client.stream("GET", self.url, headers=headers, timeout=self.TIMEOUT) as r:
+            if r.status_code != 206:
+                # 暂时性错误只让这一批改为逐个请求，之后仍然合并
+                _check_retryable(r.status_code)
+                if r.status_code == 200:
+                    # 服务器不支持多范围请求。不读取响应体，它可能是整个文件
+                    self.multirange = False
+                return []
+            body = r.read()
+            content_type = r.headers.get("Content-Type", "")
+            if not content_type.startswith("multipart/byteranges"):
+                start = self._parse_content_range(r.headers.get("Content-Range", ""))[0]
+                parts = [(start, body)]
+                if not all(start <= offset and offset + size <= start + len(body)
+                           for offset, size in ranges):
+                    self.multirange = False
+                return parts
+
+        boundary = content_type.split("boundary=", 1)[1].strip().strip('"').encode()
+        delimiter = b"--" + boundary
+        parts = []
+        pos = 0
+        while True:
+            i = body.find(delimiter, pos)
+            if i < 0 or body[i + len(delimiter):i + len(delimiter) + 2] == b"--":
+                break
+            header_end = body.find(b"\r\n\r\n", i)
+            if header_end < 0:
+                break
+            start = end = None
+            for line in body[i + len(delimiter):header_end].decode("latin-1").split("\r\n"):
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-range":
+                    start, end, _ = self._parse_content_range(value)
+            if start is None:
+                raise ValueError("多范围响应缺少Content-Range")
+            # 按Content-Range的长度取数据，避免数据中恰好出现分隔符
+            data_start = header_end + 4
+            parts.append((start, body[data_start:data_start + end - start + 1]))
+            pos = data_start + end - start + 1
+        return parts
+
+    @staticmethod
+    def _parse_content_range(value: str):
+        """解析 "bytes start-end/total"，返回 (start, end, total)"""
+        unit, _, spec = value.strip().partition(" ")
+        byte_range, _, total = spec.partition("/")
+        start, _, end = byte_range.partition("-")
+        return int(start), int(end), None if total in ("", "*") else int(total)
+
+    def _create_client(self) -> httpx.Client:
+        """创建所有线程共享的HTTP客户端；HTTP/2下并发请求复用同一条连接"""
+        return httpx.Client(timeout=self.TIMEOUT, http2=self.http2)
+
+    def _read_parallel(self, start_pos: int, view: memoryview) -> int:
+        """将大范围读取拆分为多个子范围，通过多个连接并发下载"""
+        size = len(view)
+        end_pos = start_pos + size
+        # 保证每个连接都能分到数据，之后按实测吞吐量调整分块大小
+        first_chunk = min(self.chunk_size, -(-size // self.connections))
+        lock = threading.Lock()
+        state = {"pos": start_pos, "chunk": first_chunk, "failed": False}
+
+        def worker():
+            while True:
+                with lock:
+                    pos = state["pos"]
+                    if pos >= end_pos or state["failed"]:
+                        return
+                    n = min(state["chunk"], end_pos - pos)
+                    state["pos"] = pos + n
+
+                started = time.monotonic()
+                try:
+                    self._read_into(pos, view[pos - start_pos:pos - start_pos + n])
+                except Exception:
+                    state["failed"] = True
+                    raise
+                elapsed = max(time.monotonic() - started, 1e-3)
+
+                with lock:
+                    # 让每个分块的下载时间接近 CHUNK_SECONDS
+                    target = int(n / elapsed * self.CHUNK_SECONDS)
+                    target = max(self.MIN_CHUNK_SIZE, min(self.MAX_CHUNK_SIZE, target))
+                    self.chunk_size = (self.chunk_size + target) // 2
+                    state["chunk"] = self.chunk_size
+
+        workers = min(self.connections, -(-size // first_chunk))
+        futures = [self._executor().submit(worker) for _ in range(workers)]
+        for future in futures:
+            future.result()
+        return size
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.connections)
+            return self.executor
+
+    def _read_cached(self, start_pos: int, size: int):
+        """从块缓存读取，未命中时按预读窗口整块下载；大范围读取返回None"""
+        bs = self.BLOCK_SIZE
+        first = start_pos // bs
+        last = (start_pos + size - 1) // bs
+        if (last - first + 1) * bs > self.cache_size:
+            return None
+
+        data = self._cache_hit(start_pos, size)
+        if data is not None:
+            return data
+
+        if size > self.read_ahead:
+            return None
+
+        # 预读窗口向后延伸；靠近文件末尾时向前延伸，便于一次取回zip的目录区
+        fetch_start = first * bs
+        fetch_end = min(max(fetch_start + self.read_ahead, (last + 1) * bs), self.size)
+        if fetch_end - fetch_start < self.read_ahead:
+            fetch_start = max(fetch_end - self.read_ahead, 0) // bs * bs
+        data = self._read_with_retry(fetch_start, fetch_end - fetch_start)
+        self._cache_blocks(fetch_start, data)
+
+        offset = start_pos - fetch_start
+        return data[offset:offset + size]
+
+    def _cache_hit(self, start_pos: int, size: int):
+        """范围完全在块缓存中时返回其数据，否则返回None"""
+        bs = self.BLOCK_SIZE
+        first = start_pos // bs
+        last = (start_pos + size - 1) // bs
+        with self.cache_lock:
+            blocks = []
+            for i in range(first, last + 1):
+                block = self.cache.get(i)
+                if block is None:
+                    return None
+                self.cache.move_to_end(i)
+                blocks.append(block)
+        offset = start_pos - first * bs
+        return b''.join(blocks)[offset:offset + size]
+
+    def _cache_blocks(self, start_pos: int, data) -> None:
+        """将从块边界开始的数据放入块缓存，不完整的块只在到达文件末尾时保留"""
+        bs = self.BLOCK_SIZE
+        with self.cache_lock:
+            for offset in range(0, len(data), bs):
+                block = data[offset:offset + bs]
+                if len(block) < bs and start_pos + offset + len(block) < self.size:
+                    break
+                index = (start_pos + offset) // bs
+                self.cache[index] = block
+                self.cache.move_to_end(index)
+            while len(self.cache) * bs > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def readinto_at(self, offset: int, buf) -> int:
+        """从指定位置读取到缓冲区，不改变文件位置，可供多个线程同时调用"""
         size = len(buf)
-        end_pos = min(self.pos + size - 1, self.size - 1)
-        size = end_pos - self.pos + 1
+        end_pos = min(offset + size - 1, self.size - 1)
+        size = end_pos - offset + 1
+        if size <= 0:
+            return 0
         
         try:
-            data = self._read_with_retry(self.pos, size)
-            buf[:len(data)] = data
-            self.total_bytes += len(data)
-            self.pos += len(data)
-            return len(data)
+            data = self._read_cached(offset, size) if self.cache_size else None
+            if data is not None:
+                n = len(data)
+                buf[:n] = data
+            elif self.connections > 1 and size >= 2 * self.MIN_CHUNK_SIZE:
+                n = self._read_parallel(offset, memoryview(buf)[:size])
+            else:
+                # 直接写入调用方的缓冲区，不经过中间拷贝
+                self._read_into(offset, memoryview(buf)[:size])
+                n = size
+            self.total_bytes += n
+            return n
         except Exception as e:
             raise IOError(f"读取数据失败: {str(e)}")
 
+    def read_at(self, offset: int, size: int) -> bytearray:
+        buf = bytearray(max(0, min(size, self.size - offset)))
+        self.readinto_at(offset, buf)
+        return buf
+
+    def read_tail(self, size: int) -> bytearray:
+        """一次请求读取文件末尾的size字节；经过块缓存，再次解析目录时无需重新下载"""
+        return self.read_at(max(0, self.size - size), size)
+
+    def _read_internal(self, buf: bytes) -> int:
+        n = self.readinto_at(self.pos, buf)
+        self.pos += n
+        return n
+
     def readall(self) -> bytes:
         sz = self.size - self.pos
         buf = bytearray(sz)
@@ -106,44 +430,94 @@ class HttpFile(io.RawIOBase):
     def tell(self) -> int:
         return self.pos
 
-    def __init__(self, url: str, progress_reporter=None):
+    def __init__(self, url: str, progress_reporter=None, connections: int = CONNECTIONS,
+                 cache_size: int = CACHE_SIZE, read_ahead: int = READ_AHEAD, disk_cache=None,
+                 http2: bool = False, retry_budget: int = RETRY_BUDGET):
         self.url = url
-        self.client = httpx.Client(timeout=self.TIMEOUT)
+        self.retry_budget = retry_budget
+        self.retry_lock = threading.Lock()
+        if http2 and h2 is None:
+            print("未安装h2，无法启用HTTP/2，将使用HTTP/1.1（pip install httpx[http2]）")
+            http2 = False
+        self.http2 = http2
+        self.connections = max(1, connections)
+        self.client = self._create_client()
+        self.executor_lock = threading.Lock()
         self.progress_reporter = progress_reporter
+        self.chunk_size = self.MIN_CHUNK_SIZE
+        self.executor = None
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_size = cache_size
+        self.read_ahead = read_ahead
+        self.validator = None
+        self.cache_entry = None
+        self.multirange = True
         
-        # 获取文件大小
-        retries = 0
-        last_error = None
+        # 不单独发送HEAD：第一个范围请求从Content-Range得到文件大小，
+        # 同时预取文件开头，payload头部和manifest通常都在其中
+        attempt = 0
         
-        while retries < self.MAX_RETRIES:
+        while True:
             try:
-                h = self.client.head(url, timeout=self.TIMEOUT)
-                if h.status_code != 200:
-                    raise ValueError(f"无法访问URL，状态码: {h.status_code}")
-                    
-                if h.headers.get("Accept-Ranges", "none") != "bytes":
-                    raise ValueError("服务器不支持范围请求")
-                    
-                size = int(h.headers.get("Content-Length", "0"))
-                if size == 0:
-                    raise ValueError("文件大小为0或无法获取文件大小")
+                # 先检查状态码和Content-Range再读取响应体：服务器忽略Range返回200时，
+                # 响应体是整个文件
+                with self.client.stream("GET", url, headers={"Range": f"bytes=0-{self.INITIAL_FETCH - 1}"},
+                                        timeout=self.TIMEOUT) as r:
+                    _check_retryable(r.status_code)
+                    if r.status_code == 416:
+                        raise ValueError("文件大小为0或无法获取文件大小")
+                    if r.status_code == 200:
+                        raise ValueError("服务器不支持范围请求")
+                    if r.status_code != 206:
+                        raise ValueError(f"无法访问URL，状态码: {r.status_code}")
+
+                    try:
+                        start, end, size = self._parse_content_range(r.headers.get("Content-Range", ""))
+                    except ValueError:
+                        raise ValueError("服务器返回的Content-Range无效")
+                    if not size:
+                        raise ValueError("文件大小为0或无法获取文件大小")
+                    if start != 0 or end >= self.INITIAL_FETCH:
+                        raise ValueError(f"服务器返回的范围不正确: {start}-{end}")
+                    data = r.read()
+                if len(data) != end + 1:
+                    raise RetryableError(f"读取的数据大小不匹配: 期望 {end + 1} 字节，实际读取 {len(data)} 字节")
                     
                 self.size = size
                 self.pos = 0
                 self.total_bytes = 0
+
+                # 弱ETag不能用于If-Range，此时改用Last-Modified
+                etag = r.headers.get("ETag")
+                if etag and not etag.startswith("W/"):
+                    self.validator = etag
+                else:
+                    self.validator = r.headers.get("Last-Modified")
+                if disk_cache is not None:
+                    if self.validator:
+                        self.cache_entry = disk_cache.open(url, self.validator, size)
+                        if self.cache_entry.missing(0, len(data)):
+                            self.cache_entry.write(0, data)
+                    else:
+                        print("服务器未提供ETag或Last-Modified，已禁用磁盘缓存")
+                self._cache_blocks(0, data)
                 return
                 
-            except Exception as e:
-                last_error = e
-                retries += 1
-                if retries < self.MAX_RETRIES:
-                    print(f"初始化失败，{self.RETRY_DELAY}秒后重试 ({retries}/{self.MAX_RETRIES}): {str(e)}")
-                    time.sleep(self.RETRY_DELAY)
-                    self._recreate_client()
-        
-        raise ValueError(f"初始化失败: {str(last_error)}")
+            except RETRYABLE_ERRORS as e:
+                try:
+                    self._retry_wait(attempt, e, "初始化")
+                except IOError:
+                    raise ValueError(f"初始化失败: {str(e)}")
+                attempt += 1
 
     def close(self) -> None:
+        if getattr(self, 'cache_entry', None) is not None:
+            self.cache_entry.close()
+            self.cache_entry = None
+        if getattr(self, 'executor', None) is not None:
+            self.executor.shutdown()
+            self.executor = None
         if hasattr(self, 'client'):
             try:
                 self.client.close()
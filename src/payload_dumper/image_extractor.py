@@ -1,26 +1,35 @@
+import contextlib
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import cpu_count
 from . import http_file
+from . import range_file
 from . import zipfile
 import enlighten
 
 class ImageExtractor:
-    def __init__(self, url, out_dir, target_images=None):
+    CHUNK_SIZE = 1 << 20  # 每次读取并写出的字节数
+    SEGMENT_SIZE = 32 << 20  # 未压缩的成员按此大小分段并行提取
+    REMOTE_CHUNK_SIZE = 16 << 20  # 远程文件每次读取的大小，由多个连接并发下载
+
+    def __init__(self, url, out_dir, target_images=None, connections=http_file.HttpFile.CONNECTIONS,
+                 disk_cache=None, http2=False, retry_budget=http_file.HttpFile.RETRY_BUDGET,
+                 source=None, workers=cpu_count()):
         self.url = url
+        # 已打开的远程文件，由调用方负责关闭；为None时自行打开url
+        self.source = source
+        self.connections = connections
+        self.disk_cache = disk_cache
+        self.http2 = http2
+        self.retry_budget = retry_budget
         self.out_dir = out_dir
         self.target_images = target_images.split(',') if target_images else None
+        self.workers = workers
+        self.buffers = threading.local()
+        self.remote_buffers = None
         self.manager = enlighten.get_manager()
-        self.download_progress = None
-
-    def update_download_progress(self, prog, total):
-        if self.download_progress is None and prog != total:
-            self.download_progress = self.manager.counter(
-                total=total, desc="下载进度", unit="字节", leave=False
-            )
-        if self.download_progress is not None:
-            self.download_progress.update(prog - self.download_progress.count)
-            if prog == total:
-                self.download_progress.close()
-                self.download_progress = None
 
     def _is_image_file(self, filename):
         """检查文件是否为镜像文件"""
@@ -37,51 +46,177 @@ class ImageExtractor:
             
         return any(target in filename.lower() for target in self.target_images)
 
+    def _copy(self, src, out_path, offset, report):
+        """将src剩余的数据写入输出文件的offset处，用report按字节报告进度"""
+        with src, open(out_path, 'r+b') as out_file:
+            out_file.seek(offset)
+            if isinstance(src, range_file.RangeFile) and hasattr(src.source, 'readinto_at'):
+                self._copy_remote(src, out_file, report)
+                return
+            # 本地文件中未压缩的成员由内核直接复制，其余的经过每个线程固定的缓冲区
+            range_file.copy_to(src, out_file, report)
+            view = self._buffer()
+            while True:
+                n = src.readinto(view)
+                if not n:
+                    break
+                out_file.write(view[:n])
+                report(n)
+
+    def _copy_remote(self, src, out_file, report):
+        """远程文件中的一段按REMOTE_CHUNK_SIZE读取，每次读取由多个连接并发下载。
+        同时复制的段数不超过连接数，缓冲区在这些段之间复用，内存占用与线程数无关"""
+        view = self.remote_buffers.get()
+        try:
+            if view is None:
+                view = memoryview(bytearray(self.REMOTE_CHUNK_SIZE))
+            while True:
+                n = src.readinto(view)
+                if not n:
+                    break
+                out_file.write(view[:n])
+                report(n)
+        finally:
+            self.remote_buffers.put(view)
+
+    def _buffer(self):
+        """返回当前线程的复制缓冲区，内存占用与镜像大小无关"""
+        buf = getattr(self.buffers, 'view', None)
+        if buf is None:
+            buf = self.buffers.view = memoryview(bytearray(self.CHUNK_SIZE))
+        return buf
+
+    def _out_path(self, info):
+        out_path = os.path.join(self.out_dir, os.path.basename(info.filename))
+        with open(out_path, 'wb') as out_file:
+            out_file.truncate(info.file_size)
+        return out_path
+
+    def _extract_members(self, zip_file, infos, report):
+        # 按在压缩包中的位置顺序读取，压缩的嵌套zip只需向前解压
+        extracted = []
+        for info in sorted(infos, key=lambda info: info.header_offset):
+            out_path = self._out_path(info)
+            self._copy(range_file.open_member(zip_file, info, prefetch=True), out_path, 0, report)
+            extracted.append((info.filename, out_path))
+        return extracted
+
+    def _submit_member(self, executor, zip_file, info, report):
+        """提交提取一个成员的任务，返回 (输出路径, 任务列表)。
+        未压缩的成员（包括未压缩的嵌套zip中的成员）是根文件中的一段连续数据，
+        分段后由多个线程并行读取，和顶层数据一样经过块缓存和磁盘缓存"""
+        src = range_file.open_member(zip_file, info, prefetch=True)
+        out_path = self._out_path(info)
+        if not isinstance(src, range_file.RangeFile):
+            return out_path, [executor.submit(self._copy, src, out_path, 0, report)]
+        return out_path, [
+            executor.submit(
+                self._copy,
+                range_file.RangeFile(src, offset, min(self.SEGMENT_SIZE, src.size - offset)),
+                out_path, offset, report,
+            )
+            for offset in range(0, max(src.size, 1), self.SEGMENT_SIZE)
+        ]
+
     def extract_images(self):
-        """从URL中提取镜像文件"""
+        """从URL或本地zip中提取镜像文件"""
         try:
-            with http_file.HttpFile(self.url, self.update_download_progress) as f:
-                with zipfile.ZipFile(f) as zip_file:
-                    # 获取所有文件列表
-                    all_files = zip_file.namelist()
-                    
-                    # 过滤出镜像文件
-                    image_files = [f for f in all_files if self._should_extract_file(f)]
-                    
-                    if not image_files:
-                        print("[!] 未找到任何镜像文件")
-                        return
-                    
-                    # 创建输出目录
-                    os.makedirs(self.out_dir, exist_ok=True)
-                    
-                    # 提取文件
-                    for image_file in image_files:
+            if self.source is not None:
+                source = contextlib.nullcontext(self.source)
+            else:
+                source = http_file.HttpFile(self.url, connections=self.connections,
+                                            disk_cache=self.disk_cache, http2=self.http2,
+                                            retry_budget=self.retry_budget)
+            with source as f, zipfile.ZipFile(f) as zip_file, contextlib.ExitStack() as stack:
+                # 远程的段最多同时复制连接数个，多出的线程等待空闲的缓冲区
+                self.remote_buffers = queue.LifoQueue()
+                for _ in range(getattr(f, 'connections', self.connections)):
+                    self.remote_buffers.put(None)
+
+                # 每个任务是 (名称, 成员所在的zip, 成员列表)
+                jobs = []
+                for info in zip_file.infolist():
+                    if self._should_extract_file(info.filename):
+                        jobs.append((info.filename, zip_file, [info]))
+                    elif info.filename.endswith('.zip'):
+                        # 处理嵌套的zip文件
                         try:
-                            # 处理嵌套的zip文件
-                            if image_file.endswith('.zip'):
-                                with zip_file.open(image_file) as nested_zip_data:
-                                    with zipfile.ZipFile(nested_zip_data) as nested_zip:
-                                        nested_images = [f for f in nested_zip.namelist() 
-                                                       if self._should_extract_file(f)]
-                                        for nested_image in nested_images:
-                                            out_path = os.path.join(self.out_dir, 
-                                                                  os.path.basename(nested_image))
-                                            with open(out_path, 'wb') as out_file:
-                                                out_file.write(nested_zip.read(nested_image))
-                                            print(f"[+] 已提取：{nested_image} -> {out_path}")
-                            else:
-                                # 直接提取镜像文件
-                                out_path = os.path.join(self.out_dir, 
-                                                      os.path.basename(image_file))
-                                with open(out_path, 'wb') as out_file:
-                                    out_file.write(zip_file.read(image_file))
-                                print(f"[+] 已提取：{image_file} -> {out_path}")
-                            
+                            nested_data = stack.enter_context(range_file.open_member(zip_file, info))
+                            nested_zip = stack.enter_context(zipfile.ZipFile(nested_data))
                         except Exception as e:
-                            print(f"[!] 提取 {image_file} 时出错：{str(e)}")
-                    
+                            print(f"[!] 提取 {info.filename} 时出错：{str(e)}")
+                            continue
+                        nested_images = [i for i in nested_zip.infolist()
+                                         if self._should_extract_file(i.filename)]
+                        if isinstance(nested_data, range_file.RangeFile):
+                            # 未压缩的嵌套zip中的成员直接对应根文件中的绝对范围，各自并行提取
+                            jobs.extend((i.filename, nested_zip, [i]) for i in nested_images)
+                        elif nested_images:
+                            # 压缩的嵌套zip只能顺序解压，由一个线程依次提取
+                            jobs.append((info.filename, nested_zip, nested_images))
+
+                if not jobs:
+                    print("[!] 未找到任何镜像文件")
+                    return
+
+                # 创建输出目录
+                os.makedirs(self.out_dir, exist_ok=True)
+
+                progress = self.manager.counter(
+                    total=sum(i.file_size for _, _, infos in jobs for i in infos),
+                    desc="提取进度", unit="字节", leave=False
+                )
+                # 进度由所有工作线程更新，计数和刷新需要加锁
+                progress_lock = threading.Lock()
+
+                def report(count):
+                    with progress_lock:
+                        progress.update(count)
+
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    # 每个任务的 [已提取的文件, 未完成的任务数, 是否出错]，按任务序号索引，
+                    # 不同嵌套zip中的同名成员互不影响
+                    state = {}
+                    futures = {}
+                    located = {}
+                    for index, (name, job_zip, infos) in enumerate(jobs):
+                        if len(infos) == 1:
+                            # 先并行定位成员的数据（需要读取本地文件头），再提交复制任务
+                            located[executor.submit(self._submit_member, executor, job_zip,
+                                                    infos[0], report)] = index
+                        else:
+                            state[index] = [[], 1, False]
+                            futures[executor.submit(self._extract_members, job_zip, infos, report)] = index
+
+                    for future in as_completed(located):
+                        index = located[future]
+                        name = jobs[index][0]
+                        try:
+                            out_path, tasks = future.result()
+                        except Exception as e:
+                            print(f"[!] 提取 {name} 时出错：{str(e)}")
+                            continue
+                        state[index] = [[(name, out_path)], len(tasks), False]
+                        futures.update((task, index) for task in tasks)
+
+                    # 任务的所有子任务完成后输出结果，出错时只报告一次
+                    for future in as_completed(futures):
+                        index = futures[future]
+                        extracted, _, failed = state[index]
+                        try:
+                            extracted.extend(future.result() or [])
+                        except Exception as e:
+                            if not failed:
+                                state[index][2] = True
+                                print(f"[!] 提取 {jobs[index][0]} 时出错：{str(e)}")
+                            continue
+                        state[index][1] -= 1
+                        if state[index][1] == 0 and not failed:
+                            for filename, out_path in extracted:
+                                print(f"[+] 已提取：{filename} -> {out_path}")
+                progress.close()
+
         except Exception as e:
             print(f"[!] 提取过程出错：{str(e)}")
         finally:
-            self.manager.stop() 
\ No newline at end of file
+            self.manager.stop()
@@ -0,0 +1,418 @@
+import errno
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from . import zipfile
+
+# Serializes seek+read and seek+write pairs for files that can't do
+# positional I/O.
+_seek_lock = threading.Lock()
+# Bytes handed to the kernel per copy_file_range/sendfile call, which is also
+# how often copy_to() reports progress.
+_COPY_CHUNK = 8 << 20
+# Compressed bytes fetched per read by PrefetchReader, and how many fetched
+# chunks may wait for the consumer.
+PREFETCH_CHUNK = 4 << 20
+PREFETCH_DEPTH = 2
+
+OTA_METADATA = "META-INF/com/android/metadata"
+# Property files are listed by update_engine's streaming format; the first one
+# present is used.
+OTA_PROPERTY_KEYS = ("ota-property-files", "ota-streaming-property-files")
+# How many local headers are walked looking for the OTA metadata. It is
+# written at the very start of the package so update_engine can find it.
+_MAX_LOCAL_HEADERS = 8
+
+
+def _fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def readinto_exact(f, buf):
+    # Fill buf straight from f, without intermediate bytes objects
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(view):
+        n = f.readinto(view[pos:])
+        if not n:
+            break
+        pos += n
+
+    return view[:pos]
+
+
+def readinto_at(f, offset, buf):
+    """Read into buf from `offset` of f without touching its file position.
+
+    Uses the file's own readinto_at if it has one (HttpFile, RangeFile),
+    pread/preadv on real files, and falls back to a locked seek+read."""
+    if hasattr(f, "readinto_at"):
+        return f.readinto_at(offset, buf)
+
+    view = memoryview(buf)
+    fd = _fileno(f)
+    if fd is not None and hasattr(os, "preadv"):
+        pos = 0
+        while pos < len(view):
+            n = os.preadv(fd, [view[pos:]], offset + pos)
+            if not n:
+                break
+            pos += n
+        return pos
+    if fd is not None and hasattr(os, "pread"):
+        pos = 0
+        while pos < len(view):
+            data = os.pread(fd, len(view) - pos, offset + pos)
+            if not data:
+                break
+            view[pos : pos + len(data)] = data
+            pos += len(data)
+        return pos
+
+    with _seek_lock:
+        f.seek(offset)
+        return len(readinto_exact(f, view))
+
+
+def read_at(f, offset, size):
+    buf = bytearray(size)
+    n = readinto_at(f, offset, buf)
+    return memoryview(buf)[:n]
+
+
+def write_at(f, offset, data):
+    """Write all of data at `offset` of the unbuffered file f without touching
+    its file position, so several threads can write to f at once.
+
+    Uses pwrite on real files and falls back to a locked seek+write."""
+    view = memoryview(data).cast("B")
+    fd = _fileno(f)
+    if fd is not None and hasattr(os, "pwrite"):
+        pos = 0
+        while pos < len(view):
+            pos += os.pwrite(fd, view[pos:], offset + pos)
+        return
+
+    with _seek_lock:
+        f.seek(offset)
+        pos = 0
+        while pos < len(view):
+            pos += f.write(view[pos:])
+
+
+def copy_to(f, dst, report=None):
+    """Copy the rest of RangeFile f to the real file dst inside the kernel,
+    with copy_file_range or else sendfile, advancing both file positions.
+
+    Returns the number of bytes copied. It is short (possibly 0) when f isn't
+    backed by a real file or the kernel can't copy between these files, and
+    the caller copies the remainder itself."""
+    if not isinstance(f, RangeFile):
+        return 0
+    src_fd = _fileno(f.source)
+    dst_fd = _fileno(dst)
+    if src_fd is None or dst_fd is None:
+        return 0
+    dst.flush()
+
+    calls = []
+    if hasattr(os, "copy_file_range"):
+        calls.append(lambda count: os.copy_file_range(src_fd, dst_fd, count, f.offset + f.pos))
+    if hasattr(os, "sendfile"):
+        calls.append(lambda count: os.sendfile(dst_fd, src_fd, f.offset + f.pos, count))
+
+    copied = 0
+    while calls and f.pos < f.size:
+        try:
+            n = calls[0](min(f.size - f.pos, _COPY_CHUNK))
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                               errno.EBADF, errno.EPERM):
+                raise
+            # Not supported for this pair of files, try the next call
+            calls.pop(0)
+            continue
+        if not n:
+            break
+        f.pos += n
+        copied += n
+        if report:
+            report(n)
+    return copied
+
+
+class RangeFile(io.RawIOBase):
+    """Read-only view of bytes [offset, offset + size) of another file.
+
+    All reads are positional, so several threads can read through the same
+    RangeFile (or several RangeFiles over one source) without a shared lock.
+    A RangeFile over a RangeFile reads its root source directly."""
+
+    def __init__(self, source, offset, size):
+        if isinstance(source, RangeFile):
+            offset += source.offset
+            source = source.source
+        self.source = source
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+        if hasattr(source, "read_ranges"):
+            self.read_ranges = self._read_ranges
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto_at(self, offset, buf):
+        view = memoryview(buf)
+        n = max(0, min(len(view), self.size - offset))
+        return readinto_at(self.source, self.offset + offset, view[:n])
+
+    def read_at(self, offset, size):
+        return read_at(self, offset, size)
+
+    def _read_ranges(self, ranges):
+        return self.source.read_ranges(
+            [(self.offset + offset, min(size, self.size - offset)) for offset, size in ranges]
+        )
+
+    def read_tail(self, size):
+        return self.read_at(max(0, self.size - size), size)
+
+    def readinto(self, buf):
+        n = self.readinto_at(self.pos, buf)
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %r" % pos)
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+
+class PrefetchReader(io.RawIOBase):
+    """Sequential reader over a RangeFile that fetches the next chunks on a
+    background thread while the caller is busy with the current one.
+
+    At most `depth` chunks wait in the queue, so memory stays bounded however
+    far the fetcher could run ahead. Seeking restarts the fetcher."""
+
+    def __init__(self, source, chunk_size=PREFETCH_CHUNK, depth=PREFETCH_DEPTH):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.depth = depth
+        self.pos = 0
+        self.buffer = memoryview(b"")
+        self.queue = None
+        self.stopped = None
+        self.thread = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _fetch(self, pos, chunks, stopped):
+        try:
+            while pos < self.source.size and not stopped.is_set():
+                data = self.source.read_at(pos, min(self.chunk_size, self.source.size - pos))
+                if not data:
+                    break
+                pos += len(data)
+                self._put(chunks, stopped, data)
+        except Exception as e:
+            self._put(chunks, stopped, e)
+        self._put(chunks, stopped, None)
+
+    @staticmethod
+    def _put(chunks, stopped, item):
+        # Give up once the reader has stopped consuming
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.buffer = memoryview(b"")
+
+    def readinto(self, buf):
+        if not self.buffer:
+            if self.pos >= self.source.size:
+                return 0
+            if self.thread is None:
+                self.queue = queue.Queue(self.depth)
+                self.stopped = threading.Event()
+                self.thread = threading.Thread(
+                    target=self._fetch, args=(self.pos, self.queue, self.stopped), daemon=True
+                )
+                self.thread.start()
+            data = self.queue.get()
+            if data is None:
+                self._stop()
+                return 0
+            if isinstance(data, Exception):
+                self._stop()
+                raise data
+            self.buffer = memoryview(data)
+
+        n = min(len(buf), len(self.buffer))
+        buf[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.source.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %r" % pos)
+        if 0 <= pos - self.pos <= len(self.buffer):
+            self.buffer = self.buffer[pos - self.pos :]
+        else:
+            self._stop()
+        self.pos = pos
+        return pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self._stop()
+        super().close()
+
+
+def open_member(zip_file, name, prefetch=False):
+    """Open a zip member for reading. Unencrypted STORED members are returned
+    as a RangeFile over the archive itself, bypassing ZipExtFile buffering and
+    the archive's shared file lock.
+
+    With `prefetch`, compressed members of an archive that supports positional
+    reads are decompressed from a PrefetchReader, so fetching compressed data
+    overlaps with inflating it."""
+    info = zip_file.getinfo(name) if isinstance(name, str) else name
+    if info.flag_bits & zipfile._MASK_ENCRYPTED:
+        return zip_file.open(info, "r")
+    if info.compress_type == zipfile.ZIP_STORED:
+        return RangeFile(zip_file.fp, zip_file.data_offset(info), info.file_size)
+    if prefetch and (hasattr(zip_file.fp, "readinto_at") or _fileno(zip_file.fp) is not None):
+        raw = PrefetchReader(RangeFile(zip_file.fp, zip_file.data_offset(info), info.compress_size))
+        return zipfile.ZipExtFile(raw, "r", info, close_fileobj=True)
+    return zip_file.open(info, "r")
+
+
+def _parse_property_files(metadata):
+    """Parse `name:offset:size` entries of the OTA property files out of
+    the text of META-INF/com/android/metadata, from the first key whose
+    entries include payload.bin."""
+    props = {}
+    for line in metadata.splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            props[key.strip()] = value
+    for key in OTA_PROPERTY_KEYS:
+        if key not in props:
+            continue
+        files = {}
+        for entry in props[key].split(","):
+            # The value is padded with spaces to a fixed length
+            parts = entry.strip().split(":")
+            if len(parts) != 3:
+                continue
+            try:
+                files[parts[0]] = (int(parts[1]), int(parts[2]))
+            except ValueError:
+                continue
+        if "payload.bin" in files:
+            return files
+    return None
+
+
+def read_ota_property_files(source):
+    """Return {name: (offset, size)} as listed in the OTA metadata of the zip
+    `source`, without reading its central directory. The metadata entry is
+    looked up by walking the local headers at the start of the archive.
+    Returns None if `source` isn't a zip or none of its property files list
+    payload.bin."""
+    offset = 0
+    for _ in range(_MAX_LOCAL_HEADERS):
+        header = read_at(source, offset, zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader:
+            return None
+        header = struct.unpack(zipfile.structFileHeader, header)
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            return None
+        flags = header[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
+        method = header[zipfile._FH_COMPRESSION_METHOD]
+        compress_size = header[zipfile._FH_COMPRESSED_SIZE]
+        # Without sizes in the local header the next entry can't be located
+        if (
+            flags & (zipfile._MASK_USE_DATA_DESCRIPTOR | zipfile._MASK_ENCRYPTED)
+            or compress_size == 0xFFFFFFFF
+        ):
+            return None
+
+        name_length = header[zipfile._FH_FILENAME_LENGTH]
+        data_offset = (
+            offset
+            + zipfile.sizeFileHeader
+            + name_length
+            + header[zipfile._FH_EXTRA_FIELD_LENGTH]
+        )
+        name = bytes(read_at(source, offset + zipfile.sizeFileHeader, name_length))
+        if name.decode("utf-8", "replace") == OTA_METADATA:
+            data = bytes(read_at(source, data_offset, compress_size))
+            try:
+                if method == zipfile.ZIP_DEFLATED:
+                    data = zlib.decompress(data, -15)
+                elif method != zipfile.ZIP_STORED:
+                    return None
+                return _parse_property_files(data.decode("utf-8"))
+            except (zlib.error, UnicodeDecodeError):
+                return None
+        offset = data_offset + compress_size
+    return None
+
+
+def open_ota_payload(source):
+    """Open payload.bin of an OTA package at the offset recorded in its
+    metadata, or return None so the caller can fall back to the central
+    directory."""
+    files = read_ota_property_files(source)
+    if not files or "payload.bin" not in files:
+        return None
+    offset, size = files["payload.bin"]
+    return RangeFile(source, offset, size)
@@ -0,0 +1,187 @@
+import threading
+
+# Ranges separated by at most this many bytes are fetched in one request.
+DEFAULT_MAX_GAP = 64 << 10
+# Upper bound for a single coalesced request, which also bounds the memory a
+# worker holds while the operations in it are being decoded.
+DEFAULT_MAX_SIZE = 8 << 20
+# Number of coalesced reads sent as one multi-range request, for sources that
+# support it.
+DEFAULT_MAX_RANGES = 32
+# Batches that prefetch() may have loaded before the workers have taken every
+# slice out of them.
+DEFAULT_PREFETCH_BATCHES = 4
+
+
+class CoalescedRead:
+    """A single contiguous read covering the data of one or more operations."""
+
+    def __init__(self, offset, length):
+        self.offset = offset
+        self.length = length
+        self.count = 0
+        self.pending = 0
+        self.data = None
+        self.batch = None
+
+    @property
+    def end(self):
+        return self.offset + self.length
+
+    def slice(self, offset, length, read_ranges):
+        """Return `length` bytes at `offset`. The first slice taken from any
+        read in the batch fetches the whole batch through
+        `read_ranges([(offset, length), ...])`, and a read's buffer is dropped
+        once every slice in it has been handed out."""
+        with self.batch.lock:
+            try:
+                if self.data is None:
+                    self.batch.load(read_ranges)
+                data = self.data
+            finally:
+                # A slice that failed to load is given up too, so the read
+                # is still released once the other slices are taken
+                self._release()
+
+        start = offset - self.offset
+        return memoryview(data)[start : start + length]
+
+    def discard(self):
+        """Give up a slice without reading it."""
+        with self.batch.lock:
+            self._release()
+
+    def _release(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.data = None
+            self.batch.unread -= 1
+            if self.batch.unread == 0 and self.batch.on_consumed:
+                self.batch.on_consumed()
+
+
+class ReadBatch:
+    """Coalesced reads that are fetched together in one request."""
+
+    def __init__(self):
+        self.reads = []
+        self.length = 0
+        self.lock = threading.Lock()
+        # Reads that still have slices to hand out, and what to call once
+        # none do
+        self.unread = 0
+        self.on_consumed = None
+
+    def load(self, read_ranges):
+        reads = [read for read in self.reads if read.pending and read.data is None]
+        for read, data in zip(
+            reads, read_ranges([(read.offset, read.length) for read in reads])
+        ):
+            read.data = data
+
+
+class ReadPlan:
+    def __init__(self, reads, batches, by_offset):
+        self.reads = reads
+        self.batches = batches
+        self.by_offset = by_offset
+        self.next_batch = 0
+        self.lock = threading.Lock()
+        for read in reads:
+            read.pending = read.count
+        for batch in batches:
+            batch.unread = len(batch.reads)
+
+    @property
+    def request_count(self):
+        return len(self.batches)
+
+    @property
+    def total_bytes(self):
+        return sum(read.length for read in self.reads)
+
+    def read(self, offset, length, read_ranges):
+        return self.by_offset[offset].slice(offset, length, read_ranges)
+
+    def discard(self, offset):
+        """Give up the slice at `offset` of an operation that won't be
+        processed, so its read and batch are still released."""
+        self.by_offset[offset].discard()
+
+    def prefetch(self, read_ranges, slots, stopped):
+        """Load batches in offset order ahead of the workers slicing them.
+
+        A slot of the `slots` semaphore is held from loading a batch until its
+        last slice has been taken, which bounds the memory held by fetched but
+        unprocessed data. Several threads may run this concurrently; batches
+        a worker already loaded itself are skipped. Returns when every batch
+        has been handed out or `stopped` is set."""
+        while True:
+            while not slots.acquire(timeout=0.1):
+                if stopped.is_set():
+                    return
+            with self.lock:
+                if stopped.is_set() or self.next_batch == len(self.batches):
+                    slots.release()
+                    return
+                batch = self.batches[self.next_batch]
+                self.next_batch += 1
+
+            with batch.lock:
+                if batch.unread == 0:
+                    slots.release()
+                    continue
+                try:
+                    batch.load(read_ranges)
+                except Exception:
+                    # Left to the workers, which load the batch themselves
+                    # and report the error
+                    slots.release()
+                    return
+                batch.on_consumed = slots.release
+
+
+def plan_reads(
+    ranges,
+    max_gap=DEFAULT_MAX_GAP,
+    max_size=DEFAULT_MAX_SIZE,
+    max_ranges=DEFAULT_MAX_RANGES,
+):
+    """Merge `(offset, length)` ranges into as few requests as possible.
+
+    Ranges are sorted by offset, and a range is appended to the previous read
+    if the hole between them is at most `max_gap` bytes and the merged read
+    stays within `max_size` bytes. Consecutive reads are then grouped into
+    batches of up to `max_ranges` reads and `max_size` bytes, each meant to be
+    fetched with a single multi-range request."""
+    reads = []
+    by_offset = {}
+    for offset, length in sorted(ranges):
+        if length == 0:
+            continue
+        end = offset + length
+        if reads:
+            last = reads[-1]
+            if offset - last.end <= max_gap and max(end, last.end) - last.offset <= max_size:
+                last.length = max(end, last.end) - last.offset
+                last.count += 1
+                by_offset[offset] = last
+                continue
+        read = CoalescedRead(offset, length)
+        read.count = 1
+        reads.append(read)
+        by_offset[offset] = read
+
+    batches = []
+    for read in reads:
+        if (
+            not batches
+            or len(batches[-1].reads) >= max_ranges
+            or batches[-1].length + read.length > max_size
+        ):
+            batches.append(ReadBatch())
+        batches[-1].reads.append(read)
+        batches[-1].length += read.length
+        read.batch = batches[-1]
+
+    return ReadPlan(reads, batches, by_offset)
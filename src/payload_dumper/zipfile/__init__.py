@@ -4,6 +4,7 @@ Read and write ZIP files.
 XXX references to utf-8 need further investigation.
 """
 import binascii
+import bisect
 import importlib.util
 import io
 import os
@@ -52,6 +53,8 @@ error = BadZipfile = BadZipFile      # Pre-3.2 compatibility names
 ZIP64_LIMIT = (1 << 31) - 1
 ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
 ZIP_MAX_COMMENT = (1 << 16) - 1
+# Bytes fetched from the end of remote archives when opening them
+_TAIL_FETCH_SIZE = 1 << 18
 
 # constants for Zip file compression methods
 ZIP_STORED = 0
@@ -809,12 +812,63 @@ class _SharedFile:
             self._pos = self._file.tell()
             return data
 
+    def readinto(self, b):
+        with self._lock:
+            if self._writing():
+                raise ValueError("Can't read from the ZIP file while there "
+                        "is an open writing handle on it. "
+                        "Close the writing handle before trying to read.")
+            self._file.seek(self._pos)
+            n = self._file.readinto(b)
+            self._pos = self._file.tell()
+            return n
+
     def close(self):
         if self._file is not None:
             fileobj = self._file
             self._file = None
             self._close(fileobj)
 
+class _TailFile:
+    """Read-only file over a remote archive whose last bytes have already
+    been fetched in one request.
+
+    Reads that fall inside the prefetched tail are served from memory; any
+    read starting before it is passed on to the underlying file."""
+
+    def __init__(self, file, tail, filesize):
+        self._file = file
+        self._tail = tail
+        self._tail_start = filesize - len(tail)
+        self._size = filesize
+        self._pos = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        if offset < 0:
+            raise OSError("negative seek position")
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self._size - self._pos
+        if self._pos >= self._tail_start:
+            start = self._pos - self._tail_start
+            data = bytes(self._tail[start:start + n])
+        else:
+            self._file.seek(self._pos)
+            data = self._file.read(n)
+        self._pos += len(data)
+        return data
+
+
 # Provide the tell method for unseekable stream
 class _Tellable:
     def __init__(self, fp):
@@ -850,6 +904,10 @@ class ZipExtFile(io.BufferedIOBase):
     # Chunk size to read during seek
     MAX_SEEK_READ = 1 << 24
 
+    # Distance in uncompressed bytes between snapshots of the decompressor
+    # state that seek() can resume from in deflated members.
+    CHECKPOINT_INTERVAL = 1 << 23
+
     def __init__(self, fileobj, mode, zipinfo, pwd=None,
                  close_fileobj=False):
         self._fileobj = fileobj
@@ -889,6 +947,16 @@ class ZipExtFile(io.BufferedIOBase):
         except AttributeError:
             pass
 
+        # (compressed file position, compressed bytes left, running CRC,
+        # decompressor copy) at each offset in _checkpoint_offsets. Only
+        # taken once the member has been seeked, so members that are just
+        # read through don't pay for them.
+        self._checkpoints = None
+        self._checkpoint_offsets = []
+        self._checkpointable = (self._seekable and
+                                self._compress_type == ZIP_DEFLATED and
+                                not pwd)
+
         self._decrypter = None
         if pwd:
             if zipinfo.flag_bits & _MASK_USE_DATA_DESCRIPTOR:
@@ -996,6 +1064,42 @@ class ZipExtFile(io.BufferedIOBase):
             n -= len(data)
         return buf
 
+    def readinto(self, b):
+        """Read bytes into a pre-allocated, writable bytes-like object b.
+
+        Unencrypted STORED members are read straight from the underlying
+        file into b, without going through the read buffer."""
+        if self.closed:
+            raise ValueError("read from closed file.")
+        if (self._compress_type != ZIP_STORED or self._decrypter is not None
+                or not hasattr(self._fileobj, 'readinto')):
+            return super().readinto(b)
+
+        view = memoryview(b).cast('B')
+        # Hand out any buffered data first.
+        n = min(len(view), len(self._readbuffer) - self._offset)
+        view[:n] = self._readbuffer[self._offset:self._offset + n]
+        self._offset += n
+        if self._offset >= len(self._readbuffer):
+            self._readbuffer = b''
+            self._offset = 0
+
+        while n < len(view) and self._left > 0:
+            want = min(len(view) - n, self._left, self._compress_left)
+            if want <= 0:
+                break
+            got = self._fileobj.readinto(view[n:n + want])
+            if not got:
+                raise EOFError
+            self._compress_left -= got
+            self._left -= got
+            self._update_crc(view[n:n + got])
+            n += got
+        if self._left <= 0:
+            self._eof = True
+            self._update_crc(b'')
+        return n
+
     def _update_crc(self, newdata):
         # Update the CRC using the given data.
         if self._expected_crc is None:
@@ -1077,8 +1181,58 @@ class ZipExtFile(io.BufferedIOBase):
         if self._left <= 0:
             self._eof = True
         self._update_crc(data)
+        if self._checkpoints is not None and not self._eof:
+            self._add_checkpoint()
         return data
 
+    def _add_checkpoint(self):
+        # One checkpoint per CHECKPOINT_INTERVAL of output, taken by the first
+        # read that ends past the start of the interval
+        pos = self._orig_file_size - self._left
+        offsets = self._checkpoint_offsets
+        interval = self.CHECKPOINT_INTERVAL
+        if pos // interval <= (offsets[-1] if offsets else 0) // interval:
+            return
+        # A copy of the decompressor would keep its unconsumed input (up to
+        # a whole read) alive. Flush the few bytes of output it still has
+        # pending instead, which drops that input, and resume reading the
+        # compressed data where it starts.
+        decompressor = self._decompressor.copy()
+        tail = len(decompressor.unconsumed_tail)
+        pending = decompressor.decompress(b'')
+        if (decompressor.eof or decompressor.unconsumed_tail or
+                len(pending) >= self._left):
+            return
+        offsets.append(pos + len(pending))
+        self._checkpoints.append((self._fileobj.tell() - tail,
+                                  self._compress_left + tail,
+                                  crc32(pending, self._running_crc),
+                                  decompressor))
+
+    def _resume_from_checkpoint(self, new_pos, curr_pos):
+        """Restore the decompressor from the last checkpoint at or before
+        new_pos, if that is closer than decompressing from curr_pos (or from
+        the start when seeking backwards)."""
+        if not self._checkpoints:
+            return False
+        i = bisect.bisect_right(self._checkpoint_offsets, new_pos) - 1
+        if i < 0:
+            return False
+        pos = self._checkpoint_offsets[i]
+        filepos, compress_left, crc, decompressor = self._checkpoints[i]
+        if curr_pos <= new_pos and pos <= curr_pos:
+            return False
+        self._fileobj.seek(filepos)
+        self._compress_left = compress_left
+        self._left = self._orig_file_size - pos
+        self._running_crc = crc
+        self._expected_crc = self._orig_crc
+        self._decompressor = decompressor.copy()
+        self._readbuffer = b''
+        self._offset = 0
+        self._eof = False
+        return True
+
     def _read2(self, n):
         if self._compress_left <= 0:
             return b''
@@ -1129,6 +1283,9 @@ class ZipExtFile(io.BufferedIOBase):
         if new_pos < 0:
             new_pos = 0
 
+        if self._checkpointable and self._checkpoints is None:
+            self._checkpoints = []
+
         read_offset = new_pos - curr_pos
         buff_offset = read_offset + self._offset
 
@@ -1151,6 +1308,8 @@ class ZipExtFile(io.BufferedIOBase):
             # flush read buffer
             self._readbuffer = b''
             self._offset = 0
+        elif self._resume_from_checkpoint(new_pos, curr_pos):
+            read_offset = new_pos - self.tell()
         elif read_offset < 0:
             # Position is before the current position. Reset the ZipExtFile
             self._fileobj.seek(self._orig_compress_start)
@@ -1166,8 +1325,13 @@ class ZipExtFile(io.BufferedIOBase):
             if self._decrypter is not None:
                 self._init_decrypter()
 
+        # Checkpoints are taken at most once per read, so while they are
+        # being taken read no more than an interval at a time
+        max_read = self.MAX_SEEK_READ
+        if self._checkpoints is not None:
+            max_read = min(max_read, self.CHECKPOINT_INTERVAL)
         while read_offset > 0:
-            read_len = min(self.MAX_SEEK_READ, read_offset)
+            read_len = min(max_read, read_offset)
             self.read(read_len)
             read_offset -= read_len
 
@@ -1411,6 +1575,11 @@ class ZipFile:
     def _RealGetContents(self):
         """Read in the table of contents for the ZIP file."""
         fp = self.fp
+        if hasattr(fp, 'read_tail'):
+            # Remote archive: fetch the end records and (usually) the whole
+            # central directory with a single request.
+            fp.seek(0, 2)
+            fp = _TailFile(fp, fp.read_tail(_TAIL_FETCH_SIZE), fp.tell())
         try:
             endrec = _EndRecData(fp)
         except OSError:
@@ -1672,6 +1841,28 @@ class ZipFile:
             zef_file.close()
             raise
 
+    def data_offset(self, name):
+        """Return the absolute offset of the data of member 'name' in the
+        archive file, as found after its local file header."""
+        if not self.fp:
+            raise ValueError(
+                "Attempt to use ZIP archive that was already closed")
+        zinfo = name if isinstance(name, ZipInfo) else self.getinfo(name)
+        with self._lock:
+            self.fp.seek(zinfo.header_offset)
+            fheader = self.fp.read(sizeFileHeader)
+        if len(fheader) != sizeFileHeader:
+            raise BadZipFile("Truncated file header")
+        fheader = struct.unpack(structFileHeader, fheader)
+        if fheader[_FH_SIGNATURE] != stringFileHeader:
+            raise BadZipFile("Bad magic number for file header")
+        offset = (zinfo.header_offset + sizeFileHeader
+                  + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
+        if (zinfo._end_offset is not None and
+            offset + zinfo.compress_size > zinfo._end_offset):
+            raise BadZipFile(f"Overlapped entries: {zinfo.orig_filename!r} (possible zip bomb)")
+        return offset
+
     def _open_to_write(self, zinfo, force_zip64=False):
         if force_zip64 and not self._allowZip64:
             raise ValueError(